@@ -1,18 +1,46 @@
 from flask import Flask, request, jsonify
 import os
+import re
+import mmap
 from datetime import datetime
-import json
+import orjson
 from werkzeug.utils import secure_filename
 import random
-from typing import List, Tuple
-from collections import defaultdict, Counter
+from array import array
+from typing import Tuple
+from collections import defaultdict
+from functools import lru_cache
+from itertools import chain
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 app = Flask(__name__)
 
+# Number of encoded sentences buffered before they are written out
+JSON_FLUSH_EVERY = 10000
+# Buffer size for sequential CoNLL/JSONL reads and writes
+FILE_BUFFER_SIZE = 1 << 20
+# Blank (or whitespace-only) lines separating CoNLL sentences, plus any leading ones
+SENTENCE_BREAK = re.compile(rb'(?:\A|\r?\n)(?:[ \t]*\r?\n)+')
+# NER tag (fourth column) of a CoNLL token line, split on whitespace like bytes.split();
+# -DOCSTART- lines are skipped by the same rule as is_docstart()
+NER_TAG = re.compile(rb'^[^\S\n]*(?!-DOCSTART-)\S+[^\S\n]+\S+[^\S\n]+\S+[^\S\n]+(\S+)', re.M)
+# Sentences scanned per NER_TAG.findall() call when collecting tags
+TAG_SCAN_SENTENCES = 10000
+# Inputs at least this large convert their splits in parallel worker processes
+PARALLEL_MIN_BYTES = 8 << 20
+
+def make_dir(path):
+    """Create a directory whose parent already exists, keeping it if it is already there"""
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        pass
+
 def create_data_directory(custom_name=None):
     """Create a unique directory name with date and sequence number"""
     base_dir = './data'
-    os.makedirs(base_dir, exist_ok=True)
+    make_dir(base_dir)
     
     today = datetime.now().strftime('%d-%b-%Y')
     
@@ -21,42 +49,131 @@ def create_data_directory(custom_name=None):
     else:
         base_name = today
     
-    existing_dirs = [d for d in os.listdir(base_dir) if d.startswith(base_name)]
-    if existing_dirs:
-        max_seq = max([int(d.split('-')[-1]) for d in existing_dirs])
-        seq_num = str(max_seq + 1).zfill(4)
-    else:
-        seq_num = '0001'
+    with os.scandir(base_dir) as entries:
+        existing_dirs = [e.name for e in entries if e.name.startswith(base_name) and e.is_dir(follow_symlinks=False)]
+    max_seq = max((int(d.rpartition('-')[2]) for d in existing_dirs), default=0)
+    seq_num = f"{max_seq + 1:04d}"
     
     dir_name = f"{base_name}-{seq_num}"
     full_path = os.path.join(base_dir, dir_name)
-    os.makedirs(full_path, exist_ok=True)
+    make_dir(full_path)
     
     return full_path
 
-def write_to_file(filename: str, data: List[str]):
-    """Write CoNLL data to file with proper formatting"""
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write('\n\n'.join(data) + '\n')
+@contextmanager
+def map_conll_file(source):
+    """Memory-map a CoNLL file, given as a path or an open binary file, for reading
+
+    A stream without a file descriptor is read into memory instead, and an empty file maps to b''.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f, map_conll_file(f) as buffer:
+            yield buffer
+        return
+
+    try:
+        fd = source.fileno()
+    except (AttributeError, OSError):
+        source.seek(0)
+        yield source.read()
+        return
+
+    if os.fstat(fd).st_size == 0:
+        yield b''
+    else:
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+def is_docstart(line: bytes) -> bool:
+    """Return whether a CoNLL line is a -DOCSTART- document marker"""
+    return line.lstrip().startswith(b'-DOCSTART-')
+
+def write_to_file(filename: str, source, offsets: Tuple[array, array], indices, doc_start=False):
+    """Copy the sentences at the given indices of a CoNLL source into a file with proper formatting"""
+    starts, ends = offsets
+    with open(filename, 'wb', buffering=FILE_BUFFER_SIZE) as f:
+        if doc_start:
+            f.write(source[starts[0]:ends[0]].replace(b'\r\n', b'\n') + b'\n\n')
+        for n, i in enumerate(indices):
+            if n:
+                f.write(b'\n\n')
+            f.write(source[starts[i]:ends[i]].replace(b'\r\n', b'\n'))
+        f.write(b'\n')
+
+def sentence_offsets(source) -> Tuple[array, array]:
+    """Return the start and end byte offsets of every sentence in a CoNLL buffer"""
+    starts, ends = array('Q'), array('Q')
+    pos = 0
+    for match in SENTENCE_BREAK.finditer(source):
+        if match.start() > pos:
+            starts.append(pos)
+            ends.append(match.start())
+        pos = match.end()
+    end = len(source)
+    while end > pos and source[end - 1] in b' \t\r\n':
+        end -= 1
+    if end > pos:
+        starts.append(pos)
+        ends.append(end)
+    return starts, ends
 
 def find_latest_model_config(model_dir='./models'):
     """Find the latest model configuration file"""
-    if not os.path.exists(model_dir):
+    try:
+        mtime_ns = os.stat(model_dir).st_mtime_ns
+    except FileNotFoundError:
         return None, None
-    model_folders = [f for f in os.listdir(model_dir) if os.path.isdir(os.path.join(model_dir, f))]
-    if not model_folders:
+    latest_model = _find_latest_model(model_dir, mtime_ns)
+    if latest_model is None:
         return None, None
-    latest_model = max(model_folders)
     config_path = os.path.join(model_dir, latest_model, 'config.json')
     return latest_model, config_path if os.path.exists(config_path) else None
 
+@lru_cache(maxsize=1)
+def _find_latest_model(model_dir, mtime_ns):
+    """Scan model_dir for the latest model folder, cached until the directory changes"""
+    with os.scandir(model_dir) as entries:
+        model_folders = [e.name for e in entries if e.is_dir()]
+    return max(model_folders) if model_folders else None
+
 def load_custom_map_from_json(json_file):
     """Load custom mapping from JSON configuration file"""
-    with open(json_file, 'r') as file:
-        config = json.load(file)
+    return dict(_load_custom_map_from_json(json_file, os.stat(json_file).st_mtime_ns))
+
+@lru_cache(maxsize=1)
+def _load_custom_map_from_json(json_file, mtime_ns):
+    """Parse the id2label mapping of a config file, cached until the file changes"""
+    with open(json_file, 'rb') as file:
+        config = orjson.loads(file.read())
     id2label = config.get('id2label', {})
     return {int(key): value for key, value in id2label.items()}
 
+def extend_mapping(source, offsets: Tuple[array, array], custom_mapping):
+    """Give tags of a CoNLL source missing from custom_mapping the next free ids, in order of first appearance
+
+    Returns the newly added tags.
+    """
+    starts, ends = offsets
+    seen = {}
+    # Scan a batch of sentences at a time to bound the list findall() builds
+    for first in range(0, len(starts), TAG_SCAN_SENTENCES):
+        last = min(first + TAG_SCAN_SENTENCES, len(starts)) - 1
+        seen.update(dict.fromkeys(NER_TAG.findall(source, starts[first], ends[last])))
+
+    known = set(custom_mapping.values())
+    new_tags = [tag for tag in (t.decode('utf-8') for t in seen) if tag not in known]
+    next_id = max(custom_mapping.keys()) + 1 if custom_mapping else 0
+    for tag_id, tag in enumerate(new_tags, next_id):
+        custom_mapping[tag_id] = tag
+    return new_tags
+
+def write_class_mapping(class_mapping_file, custom_mapping):
+    """Write the id to tag mapping as an importable Python module"""
+    # repr() quotes and escapes each tag so the module stays valid Python
+    body = ''.join(f"    {idx}: {tag!r},\n" for idx, tag in sorted(custom_mapping.items()))
+    with open(class_mapping_file, 'w', encoding='utf-8') as f:
+        f.write("tag_mapping = {\n" + body + "}\n")
+
 def conll_to_json(input_file, output_file, class_mapping_file, custom_mapping=None, ignore_mismatch=False):
     """Convert CoNLL file to JSON format"""
     if custom_mapping is None:
@@ -66,111 +183,143 @@ def conll_to_json(input_file, output_file, class_mapping_file, custom_mapping=No
         else:
             custom_mapping = {}
 
-    data = []
+    with map_conll_file(input_file) as source:
+        offsets = sentence_offsets(source)
+        result = sentences_to_json(source, offsets, range(len(offsets[0])), output_file,
+                                   custom_mapping, unknown_tags='add' if ignore_mismatch else 'O')
+
+    write_class_mapping(class_mapping_file, custom_mapping)
+    return result
+
+def sentences_to_json(source, offsets: Tuple[array, array], indices, output_file, custom_mapping,
+                      unknown_tags='O'):
+    """Convert the sentences at the given indices of a CoNLL source to JSON format
+
+    unknown_tags sets how a tag missing from custom_mapping is handled: 'O' writes it as 'O',
+    'add' gives it the next free id in custom_mapping (in place) and 'raise' raises ValueError.
+    """
     current_sentence = {"id": "0", "tokens": [], "ner_tags": []}
+    tokens, ner_tags = current_sentence["tokens"], current_sentence["ner_tags"]
     sentence_id = 0
-    tag_counter = Counter()
     tag_dict = {v: k for k, v in custom_mapping.items()}
     max_tag_id = max(custom_mapping.keys()) if custom_mapping else -1
+    # Token counts indexed by tag id; a list when the ids are non-negative and dense enough,
+    # otherwise (negative or sparse ids from a custom map) a dict keyed by id
+    dense_ids = not custom_mapping or (min(custom_mapping) >= 0 and max_tag_id < 2 * len(custom_mapping) + 64)
+    tag_counts = [0] * (max_tag_id + 1) if dense_ids else defaultdict(int)
     new_entities = set()
 
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('-DOCSTART-') or line == '':
-                if current_sentence["tokens"]:
-                    data.append(current_sentence)
-                    sentence_id += 1
-                    current_sentence = {"id": str(sentence_id), "tokens": [], "ner_tags": []}
+    # Unknown tags fall back to 'O' unless they are added or rejected, so the per-token
+    # lookup only reaches the slow path for tags that are really new
+    default_tag_id = None if unknown_tags in ('add', 'raise') else tag_dict.get('O')
+    get_tag_id = tag_dict.get
+    tokens_append, ner_tags_append = tokens.append, ner_tags.append
+
+    # Encode each sentence as soon as it is parsed and write the lines in batches,
+    # so only the sentence being parsed is ever held as Python objects
+    starts, ends = offsets
+    with open(output_file, 'wb', buffering=FILE_BUFFER_SIZE) as f:
+        lines = []
+        for i in indices:
+            sentence = source[starts[i]:ends[i]]
+            # -DOCSTART- usually opens its own block; any other marker line is found with
+            # one scan per sentence rather than a startswith() call per line
+            if sentence[:10] == b'-DOCSTART-':
+                sentence = sentence.partition(b'\n')[2]
+            if b'-DOCSTART-' in sentence:
+                # A marker line inside a block ends the sentence before it
+                segments = [[]]
+                for line in sentence.split(b'\n'):
+                    if is_docstart(line):
+                        segments.append([])
+                    else:
+                        segments[-1].append(line)
             else:
-                parts = line.split()
-                if len(parts) >= 4:
-                    token, ner_tag = parts[0], parts[3]
-                    current_sentence["tokens"].append(token)
-                    if ner_tag not in tag_dict:
-                        if ignore_mismatch:
-                            max_tag_id += 1
-                            tag_dict[ner_tag] = max_tag_id
-                            custom_mapping[max_tag_id] = ner_tag
-                            new_entities.add(ner_tag)
-                        else:
-                            ner_tag = 'O'
-                    current_sentence["ner_tags"].append(tag_dict[ner_tag])
-                    tag_counter[ner_tag] += 1
-
-    if current_sentence["tokens"]:
-        data.append(current_sentence)
-
-    # Write to JSON file
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for item in data:
-            json.dump(item, f, ensure_ascii=False, separators=(',', ':'))
-            f.write('\n')
-
-    # Write class mapping
-    with open(class_mapping_file, 'w', encoding='utf-8') as f:
-        f.write("tag_mapping = {\n")
-        for idx, tag in sorted(custom_mapping.items()):
-            f.write(f"    {idx}: '{tag}',\n")
-        f.write("}\n")
+                segments = (sentence.split(b'\n'),)
+            for sentence_lines in segments:
+                for line in sentence_lines:
+                    # Only the token and NER tag columns are decoded
+                    parts = line.split(None, 4)
+                    if len(parts) >= 4:
+                        ner_tag = parts[3].decode('utf-8')
+                        tokens_append(parts[0].decode('utf-8'))
+                        tag_id = get_tag_id(ner_tag, default_tag_id)
+                        if tag_id is None:
+                            if unknown_tags == 'add':
+                                max_tag_id += 1
+                                tag_dict[ner_tag] = tag_id = max_tag_id
+                                custom_mapping[max_tag_id] = ner_tag
+                                if dense_ids:
+                                    tag_counts.append(0)
+                                new_entities.add(ner_tag)
+                            elif unknown_tags == 'raise':
+                                raise ValueError(f"Tag {ner_tag!r} is missing from the tag mapping")
+                            else:
+                                # The mapping has no 'O' to fall back to either
+                                tag_id = tag_dict['O']
+                        ner_tags_append(tag_id)
+                        tag_counts[tag_id] += 1
+                if tokens:
+                    lines.append(orjson.dumps(current_sentence))
+                    if len(lines) >= JSON_FLUSH_EVERY:
+                        f.write(b'\n'.join(lines) + b'\n')
+                        lines.clear()
+                    sentence_id += 1
+                    current_sentence["id"] = str(sentence_id)
+                    tokens.clear()
+                    ner_tags.clear()
+        if lines:
+            f.write(b'\n'.join(lines) + b'\n')
 
     return {
-        "sentences_processed": len(data),
+        "sentences_processed": sentence_id,
         "unique_tags": len(custom_mapping),
-        "tag_counts": dict(tag_counter),
+        "tag_counts": {custom_mapping[tag_id]: count for tag_id, count in
+                       (enumerate(tag_counts) if dense_ids else tag_counts.items()) if count},
         "new_entities": list(new_entities)
     }
 
-def split_conll(conll_file: str, output_dir: str, ratio: Tuple[float, float, float] = (0.8, 0.1, 0.1)) -> List[str]:
-    """Split CoNLL file into train/val/test sets"""
-    info = []
-    try:
-        os.makedirs(output_dir, exist_ok=True)
+def split_indices(source, offsets: Tuple[array, array], ratio: Tuple[float, float, float]):
+    """Shuffle sentence indices and cut them into the non-empty train/val/test splits
 
-        if sum(ratio) > 1.0:
-            raise ValueError("The sum of the split ratios exceeds 1.0")
+    Returns whether the source opens with a DOCSTART block, which is kept out of the shuffle,
+    and a list of (split_name, indices) with every split a zero-copy view of the shuffled indices.
+    """
+    if sum(ratio) > 1.0:
+        raise ValueError("The sum of the split ratios exceeds 1.0")
 
-        with open(conll_file, 'r', encoding='utf-8') as f:
-            data = f.read().strip().split('\n\n')
+    starts = offsets[0]
 
-        # Handle DOCSTART
-        doc_start = data[0] if data[0].startswith("-DOCSTART-") else None
-        if doc_start:
-            data = data[1:]
+    # Handle DOCSTART
+    doc_start = bool(starts) and source[starts[0]:starts[0] + 10] == b'-DOCSTART-'
 
-        random.shuffle(data)
-        
-        total_length = len(data)
-        train_end_idx = int(total_length * ratio[0])
-        val_end_idx = train_end_idx + int(total_length * ratio[1])
+    # Shuffle sentence indices rather than the sentences themselves
+    indices = array('Q', range(1 if doc_start else 0, len(starts)))
+    random.shuffle(indices)
 
-        # Split data
-        train_data = data[:train_end_idx] if ratio[0] > 0 else []
-        val_data = data[train_end_idx:val_end_idx] if ratio[1] > 0 else []
-        test_data = data[val_end_idx:] if ratio[2] > 0 else []
+    total_length = len(indices)
+    train_end_idx = int(total_length * ratio[0])
+    val_end_idx = train_end_idx + int(total_length * ratio[1])
+    test_end_idx = total_length if ratio[2] > 0 else val_end_idx
 
-        # Add DOCSTART back
-        if doc_start:
-            for split_data in [train_data, val_data, test_data]:
-                if split_data:
-                    split_data.insert(0, doc_start)
-
-        # Write splits to files
-        files_created = []
-        if train_data:
-            write_to_file(os.path.join(output_dir, 'train.conll'), train_data)
-            files_created.append(('train.conll', len(train_data)))
-        if val_data:
-            write_to_file(os.path.join(output_dir, 'val.conll'), val_data)
-            files_created.append(('val.conll', len(val_data)))
-        if test_data:
-            write_to_file(os.path.join(output_dir, 'test.conll'), test_data)
-            files_created.append(('test.conll', len(test_data)))
-
-        return files_created
+    shuffled = memoryview(indices)
+    splits = [('train.conll', shuffled[:train_end_idx]),
+              ('val.conll', shuffled[train_end_idx:val_end_idx]),
+              ('test.conll', shuffled[val_end_idx:test_end_idx])]
+    return doc_start, [(split_name, split_data) for split_name, split_data in splits if split_data]
 
-    except Exception as e:
-        raise Exception(f"Error during CoNLL splitting: {str(e)}")
+def _convert_split(job):
+    """Write one split's CoNLL file and convert it to JSON; runs in a worker process for large inputs"""
+    input_file, offsets, indices, doc_start, conll_path, json_path, custom_mapping = job
+    with map_conll_file(input_file) as source:
+        write_to_file(conll_path, source, offsets, indices, doc_start)
+        # The leading DOCSTART block is copied into every split file, so any tokens it holds
+        # are converted along with each split as well
+        if doc_start:
+            indices = chain((0,), indices)
+        # The mapping already holds every tag of the source, so any tag that extend_mapping()
+        # missed is an error rather than a silent 'O'
+        return sentences_to_json(source, offsets, indices, json_path, custom_mapping, unknown_tags='raise')
 
 @app.route('/process_conll', methods=['POST'])
 def process_conll():
@@ -192,53 +341,84 @@ def process_conll():
         custom_map = None
         if custom_map_str:
             try:
-                custom_map = json.loads(custom_map_str)
+                custom_map = orjson.loads(custom_map_str)
                 custom_map = {int(k): v for k, v in custom_map.items()}
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 return jsonify({'error': 'Invalid custom_map JSON format'}), 400
+        else:
+            # Load the latest model mapping once and share it across all splits
+            model_name, config_path = find_latest_model_config()
+            custom_map = load_custom_map_from_json(config_path) if config_path else {}
         
         # Create directory and subdirectories
         output_dir = create_data_directory(custom_name)
         conll_dir = os.path.join(output_dir, 'conll_files')
-        os.makedirs(conll_dir, exist_ok=True)
+        make_dir(conll_dir)
         
-        # Save uploaded file
+        # Read the uploaded file straight from the request stream
         conll_file = request.files['file']
         if not conll_file:
             return jsonify({'error': 'No file uploaded'}), 400
             
         original_filename = secure_filename(conll_file.filename)
         input_path = os.path.join(conll_dir, original_filename)
-        conll_file.save(input_path)
         
         # Process the file
         processing_info = {"steps": []}
         
-        # Split the file
-        split_results = split_conll(input_path, conll_dir, ratio=ratios)
+        # Shuffle and split the file. Tags missing from the mapping get their ids up front,
+        # so the splits share no mutable state and can be written and converted independently.
+        with map_conll_file(conll_file.stream) as source:
+            offsets = sentence_offsets(source)
+            try:
+                doc_start, splits = split_indices(source, offsets, ratios)
+            except Exception as e:
+                raise Exception(f"Error during CoNLL splitting: {str(e)}")
+            new_tags = extend_mapping(source, offsets, custom_map)
+            
+            # Keep a copy of the upload unless a split file is about to take its name.
+            # Worker processes read that copy; converting in-process reads the upload itself.
+            keep_original = original_filename not in [split_name for split_name, _ in splits]
+            if keep_original:
+                with open(input_path, 'wb') as f:
+                    f.write(source)
+            parallel = keep_original and len(splits) > 1 and len(source) >= PARALLEL_MIN_BYTES
+        
+        input_file = input_path if parallel else conll_file.stream
+        jobs = [(input_file, offsets, array('Q', split_data.tobytes()), doc_start,
+                 os.path.join(conll_dir, split_name),
+                 os.path.join(output_dir, split_name.replace('.conll', '.json')),
+                 custom_map)
+                for split_name, split_data in splits]
+        if parallel:
+            with ProcessPoolExecutor(max_workers=len(jobs)) as executor:
+                results = list(executor.map(_convert_split, jobs))
+        else:
+            results = [_convert_split(job) for job in jobs]
+        
+        split_results = []
+        json_results = {}
+        known_tags = len(custom_map) - len(new_tags)
+        reported = set()
+        for (split_name, split_data), conversion_result in zip(splits, results):
+            split_results.append((split_name, len(split_data) + (1 if doc_start else 0)))
+            # Report each new tag under the first split it appears in
+            conversion_result["new_entities"] = [
+                tag for tag in new_tags if tag in conversion_result["tag_counts"] and tag not in reported
+            ]
+            reported.update(conversion_result["new_entities"])
+            conversion_result["unique_tags"] = known_tags + len(reported)
+            json_results[split_name] = conversion_result
+        
         processing_info["steps"].append({
             "action": "split",
             "files_created": split_results,
             "ratios": {"train": ratios[0], "val": ratios[1], "test": ratios[2]}
         })
         
-        # Convert each split to JSON
+        # Write the class mapping once, now that it holds every tag
         class_mapping_file = os.path.join(output_dir, 'class_mapping.py')
-        json_results = {}
-        
-        for split_name, _ in split_results:
-            conll_path = os.path.join(conll_dir, split_name)
-            json_path = os.path.join(output_dir, split_name.replace('.conll', '.json'))
-            
-            conversion_result = conll_to_json(
-                conll_path,
-                json_path,
-                class_mapping_file,
-                custom_mapping=custom_map,
-                ignore_mismatch=True
-            )
-            
-            json_results[split_name] = conversion_result
+        write_class_mapping(class_mapping_file, custom_map)
         
         processing_info["steps"].append({
             "action": "convert_to_json",